@@ -2,9 +2,11 @@ import spinedb_api as api
 from spinedb_api import DatabaseMapping, DateTime, Map, to_database
 from spinedb_api.parameter_value import convert_map_to_table, IndexedValue
 from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import make_url
 import yaml
 import sys
-from ines_tools import ines_transform
+import os
+import tulipa_fingerprint
 import pandas as pd
 import json
 import numpy as np
@@ -21,6 +23,22 @@ def nested_index_names(value, names = None, depth = 0):
             nested_index_names(y, names, depth + 1)
     return names
 
+def resampling_factor(duration, resolution) -> tuple:
+    # number of source steps per period and how many of them form one target step
+    target_resolution = settings.get("target_resolution") or resolution
+    steps_source = int(pd.to_timedelta(duration) / pd.to_timedelta(resolution))
+    factor = pd.to_timedelta(target_resolution) / pd.to_timedelta(resolution)
+    if factor < 1 or factor != int(factor) or steps_source % int(factor) != 0:
+        raise RuntimeError(f"Target resolution {target_resolution} is not a multiple of the source resolution {resolution} dividing the duration {duration}")
+    return steps_source, int(factor)
+
+def resample(values, factor : int, method : str = "mean") -> np.ndarray:
+    values = np.asarray(values, dtype = float)
+    if factor == 1:
+        return values
+    blocks = values[:len(values) // factor * factor].reshape(-1, factor)
+    return blocks.sum(axis = 1) if method == "sum" else blocks.mean(axis = 1)
+
 operations = {
     "multiply": lambda x, y: x * y,
     "add": lambda x, y: x + y,
@@ -29,25 +47,30 @@ operations = {
     "constant": lambda x, y: y
 }
 
-if len(sys.argv) > 1:
-    url_db_in = sys.argv[1]
-else:
-    exit("Please provide input database url and output database url as arguments. They should be of the form ""sqlite:///path/db_file.sqlite""")
-if len(sys.argv) > 2:
-    url_db_out = sys.argv[2]
-else:
-    exit("Please provide input database url and output database url as arguments. They should be of the form ""sqlite:///path/db_file.sqlite""")
-
 with open('ines_to_tulipa_entities.yaml', 'r') as file:
-    entities_to_copy = yaml.load(file, yaml.BaseLoader)
+    entities_to_copy = yaml.safe_load(file)
 with open('ines_to_tulipa_parameters.yaml', 'r') as file:
-    parameter_transforms = yaml.load(file, yaml.BaseLoader)
+    parameter_transforms = yaml.safe_load(file)
 with open('ines_to_tulipa_methods.yaml', 'r') as file:
     parameter_methods = yaml.safe_load(file)
 with open('ines_to_tulipa_entities_to_parameters.yaml', 'r') as file:
-    entities_to_parameters = yaml.load(file, yaml.BaseLoader)
+    entities_to_parameters = yaml.safe_load(file)
 with open('settings.yaml', 'r') as file:
     settings = yaml.safe_load(file)
+with open('tulipa_db_template.json', 'r') as file:
+    tulipa_template = json.load(file)
+
+# aggregation of each kind of time series when resampling to target_resolution, "mean" or "sum"
+resample_methods = {"availability":"mean","max_storage_level":"mean","min_storage_level":"mean","demand":"mean","inflow":"mean"}
+
+def update_resample_methods(methods : dict) -> None:
+    # checked before anything is updated, resample() itself cannot tell a misspelled method from mean
+    for series_kind, method in methods.items():
+        if series_kind not in resample_methods or method not in ["mean","sum"]:
+            raise RuntimeError(f"resample_methods needs mean or sum for one of {', '.join(resample_methods)}, got {series_kind}: {method}")
+    resample_methods.update(methods)
+
+update_resample_methods(settings.get("resample_methods") or {})
 
 def add_entity_group(db_map : DatabaseMapping, class_name : str, group : str, member : str) -> None:
     _, error = db_map.add_entity_group_item(group_name = group, member_name = member, entity_class_name=class_name)
@@ -79,9 +102,97 @@ def add_scenario_alternative(db_map : DatabaseMapping,name_scenario : str, name_
     _, error = db_map.add_scenario_alternative_item(scenario_name = name_scenario, alternative_name = name_alternative, rank = rank_int)
     if error is not None:
         raise RuntimeError(error)
-    
-def main():
+
+def check_rule(rule : dict, required : list, where : str) -> None:
+    missing = [key for key in required if key not in rule]
+    if missing:
+        raise RuntimeError(f"Mapping rule for {where} is missing {', '.join(missing)}")
+    byname = rule.get("byname")
+    if byname is not None and byname != "link" and not (isinstance(byname, list) and byname and all(isinstance(position, int) for position in byname)):
+        raise RuntimeError(f"Mapping rule for {where} needs byname as a list of positions or link, got {byname}")
+
+def compile_plan(entities_to_copy : dict, entities_to_parameters : dict, parameter_methods : dict, parameter_transforms : dict) -> dict:
+    # groups every mapping rule by what it reads, so each source class and parameter is read once
+    # all rules are checked here so a bad mapping file fails before anything is written
+    plan = {"entities": {}, "parameters": {}}
+    for source_class, target_classes in (entities_to_copy or {}).items():
+        for target_class, positions in target_classes.items():
+            if positions == "link":
+                raise RuntimeError(f"Entity copy from {source_class} to {target_class} needs a list of positions")
+            check_rule({"byname": positions}, ["byname"], f"entity copy from {source_class} to {target_class}")
+            parameters = ((entities_to_parameters or {}).get(source_class) or {}).get(target_class) or {}
+            plan["entities"].setdefault(source_class, []).append({"target_class": target_class, "byname": positions, "parameters": parameters})
+    for source_class, target_classes in (entities_to_parameters or {}).items():
+        for target_class in target_classes:
+            if target_class not in ((entities_to_copy or {}).get(source_class) or {}):
+                raise RuntimeError(f"Entity parameters for {source_class} to {target_class} have no entity copy in ines_to_tulipa_entities.yaml")
+    for source_class, methods in (parameter_methods or {}).items():
+        for source_parameter, method in methods.items():
+            check_rule(method, ["target_class","target_parameter","byname","values","default"], f"method {source_class}.{source_parameter}")
+            plan["parameters"].setdefault(source_parameter, []).append({**method, "source_class": source_class, "method": True})
+    for source_parameter, rules in (parameter_transforms or {}).items():
+        for rule in rules:
+            check_rule(rule, ["source_class","target_class","target_parameter","byname"] + (["operand"] if rule.get("operation") else []), f"parameter {source_parameter}")
+            if rule.get("operation") and rule["operation"] not in operations:
+                raise RuntimeError(f"Unknown operation {rule['operation']} for parameter {source_parameter}")
+            if rule.get("expand") not in [None, "commission", "year"]:
+                raise RuntimeError(f"Unknown expansion {rule['expand']} for parameter {source_parameter}")
+            plan["parameters"].setdefault(source_parameter, []).append(rule)
+    return plan
+
+transformation_plan = compile_plan(entities_to_copy, entities_to_parameters, parameter_methods, parameter_transforms)
+
+def commit_stage(target_db : DatabaseMapping, message : str, error_message : str) -> None:
+    # in fresh output mode everything is written in a single commit at the end of main
+    if settings.get("fresh_output", False):
+        return
+    try:
+        target_db.commit_session(message)
+    except:
+        print(error_message)
+
+def fresh_target_paths(url_db : str) -> tuple:
+    # the new output is built next to the old one and only swapped in after a successful conversion
+    url = make_url(url_db)
+    target_path = url.database
+    if url.get_backend_name() != "sqlite" or not target_path:
+        raise RuntimeError("Fresh output mode needs a sqlite output url of the form ""sqlite:///path/db_file.sqlite""")
+    temp_path = target_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    return target_path, temp_path
+
+def main(url_db_in : str, url_db_out : str) -> None:
     with DatabaseMapping(url_db_in) as source_db:
+        write_target(source_db, url_db_out)
+
+def write_target(source_db : DatabaseMapping, url_db_out : str) -> None:
+    if settings.get("fresh_output", False):
+        target_path, temp_path = fresh_target_paths(url_db_out)
+        try:
+            with DatabaseMapping("sqlite:///" + temp_path, create=True) as target_db:
+                _, errors = api.import_data(target_db, **tulipa_template)
+                if errors:
+                    raise RuntimeError(errors)
+                convert(source_db, target_db)
+                fingerprint = tulipa_fingerprint.fingerprint_digest(tulipa_fingerprint.fingerprint(tulipa_fingerprint.rows_from_db_map(target_db)))
+                unchanged = os.path.exists(target_path) and tulipa_fingerprint.stored_fingerprint(target_path) == fingerprint
+                if not unchanged:
+                    print("writing output")
+                    store_fingerprint(target_db, fingerprint)
+                    target_db.commit_session("Converted from INES")
+            if unchanged:
+                print("output unchanged, skipping write")
+                os.remove(temp_path)
+            else:
+                check_fingerprint(temp_path, fingerprint)
+                os.replace(temp_path, target_path)
+        except BaseException:
+            # a failed or interrupted conversion leaves neither a new output nor a stray temporary file
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    else:
         with DatabaseMapping(url_db_out) as target_db:
             ## Empty the database
             target_db.purge_items('parameter_value')
@@ -90,39 +201,63 @@ def main():
             target_db.purge_items('scenario')
             target_db.refresh_session()
             target_db.commit_session("Purged stuff")
+            convert(source_db, target_db)
+            fingerprint = tulipa_fingerprint.fingerprint_digest(tulipa_fingerprint.fingerprint(tulipa_fingerprint.rows_from_db_map(target_db)))
+            store_fingerprint(target_db, fingerprint)
+            target_db.commit_session("Added fingerprint")
+        if make_url(url_db_out).get_backend_name() == "sqlite":
+            check_fingerprint(make_url(url_db_out).database, fingerprint)
+
+def check_fingerprint(path : str, fingerprint : str) -> None:
+    # the stored fingerprint must be reproducible by reading the written file with tulipa_fingerprint.py
+    if not settings.get("check_fingerprint", False):
+        return
+    written = tulipa_fingerprint.fingerprint_digest(tulipa_fingerprint.fingerprint(tulipa_fingerprint.rows_from_sqlite(path)))
+    if written != fingerprint:
+        raise RuntimeError(f"Fingerprint of the written output {written} does not match the stored fingerprint {fingerprint}")
+
+def store_fingerprint(target_db : DatabaseMapping, fingerprint : str) -> None:
+    for metadata_item in target_db.get_metadata_items(name = tulipa_fingerprint.fingerprint_metadata_name):
+        target_db.remove_item("metadata",metadata_item["id"])
+    _, error = target_db.add_metadata_item(name = tulipa_fingerprint.fingerprint_metadata_name, value = fingerprint)
+    if error is not None:
+        raise RuntimeError(error)
 
-            ## Copy alternatives
-            for alternative in source_db.get_alternative_items():
-                target_db.add_alternative_item(name=alternative["name"])
-            for scenario in source_db.get_scenario_items():
-                target_db.add_scenario_item(name=scenario["name"])
-            for scenario_alternative in source_db.get_scenario_alternative_items():
-                target_db.add_scenario_alternative_item(alternative_name=scenario_alternative["alternative_name"],
-                                                        scenario_name=scenario_alternative["scenario_name"],
-                                                        rank=scenario_alternative["rank"])
-
-            # creating main entities
-            print("adding periods")
-            add_periods(source_db, target_db)
-            print("adding entities")
-            add_entities(source_db, target_db)
-            print("adding capacities")
-            add_capacity(source_db,target_db)
-            print("adding existing units")
-            add_existing_units(source_db,target_db)
-            print("adding investment and retirement methods")
-            add_investable_decommisionable(source_db,target_db)
-            print("adding fixed units")
-            add_fixed_units(source_db,target_db)
-            print("adding flow relationships")
-            add_flow_relationships(source_db,target_db)
-            print("adding costs")
-            add_costs(source_db,target_db)
-            print("adding emissions")
-            add_emissions(source_db,target_db)
-            print("adding profiles")
-            add_profiles(source_db,target_db)
-            
+def convert(source_db,target_db):
+
+    ## Copy alternatives
+    for alternative in source_db.get_alternative_items():
+        target_db.add_alternative_item(name=alternative["name"])
+    for scenario in source_db.get_scenario_items():
+        target_db.add_scenario_item(name=scenario["name"])
+    for scenario_alternative in source_db.get_scenario_alternative_items():
+        target_db.add_scenario_alternative_item(alternative_name=scenario_alternative["alternative_name"],
+                                                scenario_name=scenario_alternative["scenario_name"],
+                                                rank=scenario_alternative["rank"])
+
+    # creating main entities
+    print("adding periods")
+    add_periods(source_db, target_db)
+    print("adding mapped entities")
+    copy_plan_entities(transformation_plan, source_db, target_db)
+    print("adding entities")
+    add_entities(source_db, target_db)
+    print("adding mapped parameters")
+    apply_plan_parameters(transformation_plan, source_db, target_db)
+    print("adding capacities")
+    add_capacity(source_db,target_db)
+    print("adding existing units")
+    add_existing_units(source_db,target_db)
+    print("adding investment and retirement methods")
+    add_investable_decommisionable(source_db,target_db)
+    print("adding fixed units")
+    add_fixed_units(source_db,target_db)
+    print("adding flow relationships")
+    add_flow_relationships(source_db,target_db)
+    print("adding emissions")
+    add_emissions(source_db,target_db)
+    print("adding profiles")
+    add_profiles(source_db,target_db)
 
 def add_periods(source_db,target_db):
 
@@ -130,39 +265,25 @@ def add_periods(source_db,target_db):
     periods       = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "period")[0]["value"])["data"]
     resolution    = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "time_resolution")[0]["value"])["data"]
     
-    steps = pd.to_timedelta(duration) / pd.to_timedelta(resolution)
+    steps_source, factor = resampling_factor(duration, resolution)
+    steps = steps_source / factor
+    # length stays in modeled hours, only the number of (coarser) time steps shrinks
+    hours_source = pd.to_timedelta(resolution) / pd.Timedelta(hours = 1)
+    length = steps_source * hours_source
+    step_hours = factor * hours_source
     for period in periods:
         add_entity(target_db,"year",(period[1:],))
         add_parameter_value(target_db,"year","is_milestone","Base",(period[1:],),True)
-        add_parameter_value(target_db,"year","length","Base",(period[1:],),steps)
+        add_parameter_value(target_db,"year","length","Base",(period[1:],),length)
+        if step_hours != 1.0:
+            add_parameter_value(target_db,"year","resolution","Base",(period[1:],),step_hours)
         add_parameter_value(target_db,"year","timeframe_data","Base",(period[1:],),{"type":"map","index_type":"str","index_name":"period","data":{1:steps}})
         add_entity(target_db,"commission",(period[1:],))
     
-    try:
-        target_db.commit_session("Added periods")
-    except:
-        print("commit adding periods error")
+    commit_stage(target_db,"Added periods","commit adding periods error")
 
 def add_entities(source_db,target_db):
 
-    storages = []
-    for entity in [entity_item for entity_item in source_db.get_entity_items(entity_class_name = "node")]:
-
-        add_entity(target_db,"asset",(entity["name"],))
-        node_type = source_db.get_parameter_value_item(entity_class_name = "node", entity_byname = (entity["name"],), alternative_name ="Base", parameter_definition_name = "node_type")
-        if node_type:
-            if node_type["parsed_value"] == "storage":
-                storages.append(entity["name"])
-                add_parameter_value(target_db,"asset","type","Base",(entity["name"],),"storage")
-            else:
-                add_parameter_value(target_db,"asset","type","Base",(entity["name"],),"hub")
-            
-    for entity in [entity_item for entity_item in source_db.get_entity_items(entity_class_name = "link")]:
-        node1_node2 = [(entity_link["entity_byname"][0],entity_link["entity_byname"][2]) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if entity["name"] == entity_link["entity_byname"][1]]
-        for node_1, node_2 in node1_node2:
-            add_entity(target_db,"asset__asset",(node_1,node_2))
-            add_parameter_value(target_db,"asset__asset","is_transport","Base",(node_1,node_2),True)
-        
     for entity in [entity_item for entity_item in source_db.get_entity_items(entity_class_name = "unit")]:
         nodes1 = [entity_from["entity_byname"][0] for entity_from in source_db.get_entity_items(entity_class_name = "node__to_unit") if entity["name"] == entity_from["entity_byname"][1]]
         nodes2 = [entity_to["entity_byname"][1] for entity_to in source_db.get_entity_items(entity_class_name = "unit__to_node") if entity["name"] == entity_to["entity_byname"][0]]
@@ -179,21 +300,11 @@ def add_entities(source_db,target_db):
             for node2 in nodes2:
                 add_entity(target_db,"asset__asset",(entity["name"],node2))
 
-    try:
-        target_db.commit_session("Added entities")
-    except:
-        print("commit adding entities error")
-    
-    return storages
+    commit_stage(target_db,"Added entities","commit adding entities error")
 
 def add_capacity(source_db,target_db):
 
     units_cap = {entity_item["name"]:{} for entity_item in source_db.get_entity_items(entity_class_name = "unit")}
-    for storage_capacity in source_db.get_parameter_value_items(parameter_definition_name = "storage_capacity"):
-        add_parameter_value(target_db,"asset","capacity_storage_energy",storage_capacity["alternative_name"],storage_capacity["entity_byname"],storage_capacity["parsed_value"])
-        add_parameter_value(target_db,"asset","capacity",storage_capacity["alternative_name"],storage_capacity["entity_byname"],storage_capacity["parsed_value"])
-        add_parameter_value(target_db,"asset","storage_method_energy",storage_capacity["alternative_name"],storage_capacity["entity_byname"],True)
-    
     for entity_capacity in source_db.get_parameter_value_items(parameter_definition_name = "capacity"):
 
         if entity_capacity["entity_class_name"] == "link":
@@ -226,7 +337,7 @@ def add_capacity(source_db,target_db):
                 if not isinstance(units_cap[unit][node][1],dict): 
                     add_parameter_value(target_db,"asset","capacity","Base",(unit,),units_cap[unit][node][1])
                 else:
-                    exit("need to implement a capability for different capacities in different comission years for unit", unit)
+                    raise RuntimeError(f"need to implement a capability for different capacities in different comission years for unit {unit}")
         else:
             to_condition = False
             for node in units_cap[unit]:
@@ -248,7 +359,7 @@ def add_capacity(source_db,target_db):
                             else:
                                 add_parameter_value(target_db,"asset__asset__commission","capacity_coefficient","Base",(unit,node,commission_year["name"]),unit_capacity/units_cap[unit][node][1])
             else:
-                exit("need to implement a capability for different capacities in different comission years and multiple node__to_unit flows for unit",unit)
+                raise RuntimeError(f"need to implement a capability for different capacities in different comission years and multiple node__to_unit flows for unit {unit}")
 
     # Filters apply: No capacity, then capacity_coefficient = 0
     years = [year["name"] for year in target_db.get_entity_items(entity_class_name = "commission")]
@@ -281,10 +392,7 @@ def add_capacity(source_db,target_db):
                         pass
                     add_parameter_value(target_db,entity_class_target,"capacity_coefficient","Base",entity_target,0.0)
         
-    try:
-        target_db.commit_session("Added capacities")
-    except:
-        print("commit adding capacities error")
+    commit_stage(target_db,"Added capacities","commit adding capacities error")
 
 def add_existing_units(source_db,target_db):
 
@@ -292,6 +400,7 @@ def add_existing_units(source_db,target_db):
     existing_name = {"unit":"units_existing","node":"storages_existing","link":"links_existing"}
     target_param = {"unit":"initial_units","node":"initial_storage_units","link":"initial_export_units"}
     years = [year["name"] for year in target_db.get_entity_items(entity_class_name = "year")]
+    sparse = settings.get("sparse_commission_years", False)
 
     for entity_class in ["unit","node","link"]:
         existing_parameters = source_db.get_parameter_value_items(entity_class_name = entity_class, parameter_definition_name = existing_name[entity_class])
@@ -304,11 +413,6 @@ def add_existing_units(source_db,target_db):
                     entity_class_target = "asset__asset__commission__year"
                     entity_bynames = [(entity_link["entity_byname"][0],entity_link["entity_byname"][2],min(years),year) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if existing_parameter["entity_byname"][0] == entity_link["entity_byname"][1]]
                 for entity_byname in entity_bynames:
-                    try:
-                        add_entity(target_db,entity_class_target,entity_byname)
-                    except:
-                        print("not added",entity_class_target,entity_byname)
-                        pass
                     if existing_parameter["type"] == "map":
                         existing_dict = dict(zip([i[1:] for i in existing_parameter["parsed_value"].indexes],existing_parameter["parsed_value"].values))
                         if len(existing_dict) > 1:
@@ -318,17 +422,23 @@ def add_existing_units(source_db,target_db):
                     elif  existing_parameter["type"] == "float": 
                         cap_value = existing_parameter["parsed_value"]
 
+                    # sparse: zero initial units is Tulipa's default, in other alternatives a zero overrides Base
+                    if sparse and cap_value == 0.0 and existing_parameter["alternative_name"] == "Base":
+                        continue
+                    try:
+                        add_entity(target_db,entity_class_target,entity_byname)
+                    except:
+                        print("not added",entity_class_target,entity_byname)
+                        pass
                     add_parameter_value(target_db,entity_class_target,target_param[entity_class],existing_parameter["alternative_name"],entity_byname,cap_value)
                 
-    try:
-        target_db.commit_session("Added existing units")
-    except:
-        print("commit adding existing units error")
+    commit_stage(target_db,"Added existing units","commit adding existing units error")
 
 def add_investable_decommisionable(source_db,target_db):
 
     years   = [year["name"] for year in target_db.get_entity_items(entity_class_name = "year")]
     years_c = [year["name"] for year in target_db.get_entity_items(entity_class_name = "commission")]
+    sparse  = settings.get("sparse_commission_years", False)
 
     investment_method = {"unit":"investment_method","node":"storage_investment_method","link":"investment_method"}
     retirement_method = {"unit":"retirement_method","node":"storage_retirement_method","link":"retirement_method"}
@@ -359,7 +469,11 @@ def add_investable_decommisionable(source_db,target_db):
                     else:
                         global_condition = False
 
-            
+
+            # is investable?
+            investment_value_ = source_db.get_parameter_value_item(entity_class_name = entity_class, parameter_definition_name = investment_method[entity_class], entity_byname = entity_item["entity_byname"], alternative_name = "Base")
+            investment_condition = False if not investment_value_ else (True if investment_value_["parsed_value"] != "not_allowed" else False)
+
             # is decommisionable?
             retirement_value_ = source_db.get_parameter_value_item(entity_class_name = entity_class, parameter_definition_name = retirement_method[entity_class], entity_byname = entity_item["entity_byname"], alternative_name = "Base")
             if not retirement_value_:
@@ -368,14 +482,13 @@ def add_investable_decommisionable(source_db,target_db):
                 decommission_condition = True if retirement_value_["parsed_value"] != "not_retired" else False
             
             if decommission_condition and global_condition:
-                for year_c in years_c:
+                # sparse: without investments the only vintage holding units is the initial one
+                vintages = years_c if (investment_condition or not sparse) else [min(years_c)]
+                for year_c in vintages:
                     for year in years:
                     
                         if year >= year_c:
-                            if entity_class != "link":
-                                entity_bynames = [(entity_item["entity_byname"][0],year_c,year)]
-                            else:
-                                entity_bynames = [(entity_link["entity_byname"][0],entity_link["entity_byname"][2],year_c,year) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if entity_item["name"] == entity_link["entity_byname"][1]]
+                            entity_bynames = [original_byname + (year_c,year) for original_byname in original_bynames]
 
                             for entity_byname in entity_bynames:
                                 try:
@@ -384,15 +497,9 @@ def add_investable_decommisionable(source_db,target_db):
                                     pass
                                 add_parameter_value(target_db,target_decommissionable[entity_class],"decommissionable","Base",entity_byname,decommission_condition)
             
-            # is investable?
-            investment_value_ = source_db.get_parameter_value_item(entity_class_name = entity_class, parameter_definition_name = investment_method[entity_class], entity_byname = entity_item["entity_byname"], alternative_name = "Base")
-            investment_condition = False if not investment_value_ else (True if investment_value_["parsed_value"] != "not_allowed" else False)
             if investment_condition and global_condition:
                 for year in years:
-                    if entity_class != "link":
-                        entity_bynames = [(entity_item["entity_byname"][0],year)]
-                    else:
-                        entity_bynames = [(entity_link["entity_byname"][0],entity_link["entity_byname"][2],year) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if entity_item["name"] == entity_link["entity_byname"][1]]
+                    entity_bynames = [original_byname + (year,) for original_byname in original_bynames]
 
                     for entity_byname in entity_bynames:
                         try:    
@@ -403,10 +510,7 @@ def add_investable_decommisionable(source_db,target_db):
     
     # It is decommissionable every year, the new units
     
-    try:
-        target_db.commit_session("Added ables")
-    except:
-        print("commit adding ables error")
+    commit_stage(target_db,"Added ables","commit adding ables error")
 
 def add_fixed_units(source_db,target_db):
 
@@ -414,6 +518,7 @@ def add_fixed_units(source_db,target_db):
     existing_name = {"unit":"units_fix_cumulative","node":"storages_fix_cumulative","link":"links_fix_cumulative"}
     target_param = {"unit":"initial_units","node":"initial_storage_units","link":"initial_export_units"}
     years = [year["name"] for year in target_db.get_entity_items(entity_class_name = "year")]
+    sparse = settings.get("sparse_commission_years", False)
     if_decommissionable = target_db.get_parameter_value_items(parameter_definition_name = "decommissionable")
     if_investable = target_db.get_parameter_value_items(parameter_definition_name = "investable")
     
@@ -428,18 +533,20 @@ def add_fixed_units(source_db,target_db):
                     entity_class_target = "asset__asset__commission__year"
                     entity_bynames = [(entity_link["entity_byname"][0],entity_link["entity_byname"][2],year,year) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if existing_parameter["entity_byname"][0] == entity_link["entity_byname"][1]]
                 for entity_byname in entity_bynames:
-                    try:
-                        add_entity(target_db,entity_class_target,entity_byname)
-                    except:
-                        print("not added",entity_class_target,entity_byname)
-                        pass
                     if existing_parameter["type"] == "map":
                         existing_dict = dict(zip([i[1:] for i in existing_parameter["parsed_value"].indexes],existing_parameter["parsed_value"].values))
                         cap_value = existing_dict[year]
                     elif  existing_parameter["type"] == "float": 
                         cap_value = existing_parameter["parsed_value"]
 
-                    add_parameter_value(target_db,entity_class_target,target_param[entity_class],existing_parameter["alternative_name"],entity_byname,cap_value)
+                    # sparse: zero initial units is Tulipa's default, in other alternatives a zero overrides Base
+                    if not (sparse and cap_value == 0.0 and existing_parameter["alternative_name"] == "Base"):
+                        try:
+                            add_entity(target_db,entity_class_target,entity_byname)
+                        except:
+                            print("not added",entity_class_target,entity_byname)
+                            pass
+                        add_parameter_value(target_db,entity_class_target,target_param[entity_class],existing_parameter["alternative_name"],entity_byname,cap_value)
                 
                     target_comparison = (existing_parameter["entity_byname"][0],) if entity_class != "link" else (existing_parameter["entity_byname"][0],existing_parameter["entity_byname"][1])
                     limit_list = 1  if entity_class != "link" else 2
@@ -457,10 +564,7 @@ def add_fixed_units(source_db,target_db):
                     except:
                         pass
                     
-    try:
-        target_db.commit_session("Added fixed units")
-    except:
-        print("commit adding fixed units error")
+    commit_stage(target_db,"Added fixed units","commit adding fixed units error")
 
 def add_flow_relationships(source_db,target_db):
 
@@ -475,6 +579,7 @@ def add_flow_relationships(source_db,target_db):
     duration      = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "duration")[0]["value"])["data"]
     starttime_sp  = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "start_time")[0]["value"])["data"]
     resolution    = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "time_resolution")[0]["value"])["data"]
+    steps_source, _ = resampling_factor(duration, resolution)
     
     for parameter_name in ["equality_ratio"]:
         for parameter_dict in source_db.get_parameter_value_items(parameter_definition_name = parameter_name):
@@ -511,8 +616,8 @@ def add_flow_relationships(source_db,target_db):
                             add_alternative(target_db,alternative_name)
                         except:
                             pass
-                        steps = pd.to_timedelta(duration) / pd.to_timedelta(resolution)
-                        mean_data = data.iloc[data.index.tolist().index(element):data.index.tolist().index(element)+int(steps),data.columns.tolist().index("value")].mean()
+                        start = data.index.get_loc(element)
+                        mean_data = data["value"].to_numpy()[start:start+steps_source].mean()
                         for year in years:
                             add_parameter_value(target_db,"asset_flow__asset_flow","ratio",f"wy{str(pd.Timestamp(element).year)}",(parameter_dict["entity_byname"][0],parameter_dict["entity_byname"][1],year,parameter_dict["entity_byname"][2],parameter_dict["entity_byname"][3],year),float(mean_data))
             
@@ -526,83 +631,67 @@ def add_flow_relationships(source_db,target_db):
                         except:
                             pass
                         add_parameter_value(target_db,entity_class_co2,"capacity_coefficient","Base",entity_byname_co2,0.0)
-    try:
-        target_db.commit_session("Added flows")
-    except:
-        print("commit flows error")
-
-def add_costs(source_db,target_db):
+    commit_stage(target_db,"Added flows","commit flows error")
+
+def copy_plan_entities(plan,source_db,target_db):
+
+    for source_class, copies in plan["entities"].items():
+        for entity in source_db.get_entity_items(entity_class_name = source_class):
+            for copy in copies:
+                target_byname = tuple(entity["entity_byname"][position] for position in copy["byname"])
+                add_entity(target_db,copy["target_class"],target_byname)
+                for target_parameter, value in copy["parameters"].items():
+                    add_parameter_value(target_db,copy["target_class"],target_parameter,"Base",target_byname,value)
+
+    commit_stage(target_db,"Added mapped entities","commit adding mapped entities error")
+
+def apply_plan_parameters(plan,source_db,target_db):
+
+    years = {"commission":[year["name"] for year in target_db.get_entity_items(entity_class_name = "commission")],
+             "year":[year["name"] for year in target_db.get_entity_items(entity_class_name = "year")]}
+    link_nodes = {}
+    for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node"):
+        link_nodes.setdefault(entity_link["entity_byname"][1],[]).append((entity_link["entity_byname"][0],entity_link["entity_byname"][2]))
+
+    for source_parameter, rules in plan["parameters"].items():
+        rules_by_class = {}
+        for rule in rules:
+            rules_by_class.setdefault(rule["source_class"],[]).append(rule)
+
+        rows = []
+        for parameter_dict in source_db.get_parameter_value_items(parameter_definition_name = source_parameter):
+            for rule in rules_by_class.get(parameter_dict["entity_class_name"],[]):
+                if rule["byname"] == "link":
+                    target_bynames = link_nodes.get(parameter_dict["entity_byname"][0],[])
+                else:
+                    target_bynames = [tuple(parameter_dict["entity_byname"][position] for position in rule["byname"])]
+
+                if rule.get("method"):
+                    values = {(): rule["values"].get(parameter_dict["parsed_value"],rule["default"])}
+                elif rule.get("expand"):
+                    if parameter_dict["type"] == "map":
+                        values = {(index[1:],): value for index, value in zip(parameter_dict["parsed_value"].indexes,parameter_dict["parsed_value"].values)}
+                    elif parameter_dict["type"] == "float":
+                        values = {(min(years[rule["expand"]]),): parameter_dict["parsed_value"]}
+                    else:
+                        continue
+                else:
+                    values = {(): parameter_dict["parsed_value"]}
 
-    # commission parameters
-    target_parameters = {"investment_cost": "investment_cost","storage_investment_cost":"investment_cost_storage_energy", "fixed_cost": "fixed_cost","storage_fixed_cost":"fixed_cost_storage_energy"}
-    target_commission = {"node__to_unit":"asset__commission","unit__to_node":"asset__commission","node":"asset__commission","link":"asset__asset__commission"}    
-    yearsc = [year["name"] for year in target_db.get_entity_items(entity_class_name = "commission")]
-    for source_parameter in target_parameters:
+                if rule.get("operation"):
+                    values = {index: operations[rule["operation"]](value,rule["operand"]) for index, value in values.items()}
+                for target_byname in target_bynames:
+                    for index, value in values.items():
+                        rows.append((rule["target_class"],tuple(target_byname) + index,rule["target_parameter"],parameter_dict["alternative_name"],value))
 
-        parameter_list = source_db.get_parameter_value_items(parameter_definition_name = source_parameter)
-        if parameter_list:
-            for parameter_dict in parameter_list:
-                
-                if parameter_dict["type"] == "map":
-                    periods = [i[1:] for i in parameter_dict["parsed_value"].indexes]
-                    dict_values = {period:parameter_dict["parsed_value"].values[periods.index(period)] for period in periods}
-                elif parameter_dict["type"] == "float":
-                    periods = [min(yearsc)]
-                    dict_values = {period:parameter_dict["parsed_value"] for period in periods}
-                
-                for index_ in periods:
-                    if parameter_dict["entity_class_name"] in ["node__to_unit","unit__to_node"]:
-                        target_entity_class   = target_commission[parameter_dict["entity_class_name"]]
-                        target_unit = parameter_dict["entity_byname"][1] if parameter_dict["entity_class_name"] == "node__to_unit" else parameter_dict["entity_byname"][0]
-                        target_entity_bynames = [(target_unit,index_)]
-                    elif parameter_dict["entity_class_name"] == "link":
-                        target_entity_class   = target_commission[parameter_dict["entity_class_name"]]
-                        target_entity_bynames =  [(entity_link["entity_byname"][0],entity_link["entity_byname"][2],index_) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if parameter_dict["entity_byname"][0] == entity_link["entity_byname"][1]]
-                    else:
-                        target_entity_class   = target_commission[parameter_dict["entity_class_name"]]
-                        target_entity_bynames = [( parameter_dict["entity_byname"][0],index_)]
-                    for target_entity_byname in target_entity_bynames:
-                        try:
-                            add_entity(target_db,target_entity_class,target_entity_byname)
-                        except:
-                            pass
-                        add_parameter_value(target_db,target_entity_class,target_parameters[source_parameter],parameter_dict["alternative_name"],target_entity_byname,dict_values[index_])
-                
-                
-    #milestone parameters
-    target_parameters = {"other_operational_cost": "variable_cost","operational_cost":"variable_cost"}
-    target_entity_class   = "asset__asset__year"
-    yearsm = [year["name"] for year in target_db.get_entity_items(entity_class_name = "year")]
-    for source_parameter in target_parameters:
-        parameter_list = source_db.get_parameter_value_items(parameter_definition_name = source_parameter)
-        if parameter_list:
-            for parameter_dict in parameter_list:
-                if parameter_dict["type"] == "map":
-                    periods = [i[1:] for i in parameter_dict["parsed_value"].indexes]
-                    dict_values = {period:parameter_dict["parsed_value"].values[periods.index(period)] for period in periods}
-                elif parameter_dict["type"] == "float":
-                    periods = [min(yearsm)]
-                    dict_values = {period:parameter_dict["parsed_value"] for period in periods}
-                
-                for index_ in periods:
-                    if parameter_dict["entity_class_name"] in ["node__to_unit","unit__to_node"]:
-                        target_entity_bynames = [(parameter_dict["entity_byname"][0],parameter_dict["entity_byname"][1],index_)] if parameter_dict["entity_class_name"] == "unit__to_node" else [(parameter_dict["entity_byname"][1],parameter_dict["entity_byname"][0],index_)]
-                    elif parameter_dict["entity_class_name"] == "link":
-                        target_entity_bynames =  [(entity_link["entity_byname"][0],entity_link["entity_byname"][2],index_) for entity_link in source_db.get_entity_items(entity_class_name = "node__link__node") if parameter_dict["entity_byname"][0] == entity_link["entity_byname"][1]]
-                    elif parameter_dict["entity_class_name"] == "node__link__node":
-                        target_entity_bynames =  [(parameter_dict["entity_byname"][0],parameter_dict["entity_byname"][2],index_)]
-                    for target_entity_byname in target_entity_bynames:
-                        try:
-                            add_entity(target_db,target_entity_class,target_entity_byname)
-                        except:
-                            pass
-                        add_parameter_value(target_db,target_entity_class,target_parameters[source_parameter],parameter_dict["alternative_name"],target_entity_byname,dict_values[index_])
+        for target_class, target_byname, target_parameter, alternative_name, value in rows:
+            try:
+                add_entity(target_db,target_class,target_byname)
+            except:
+                pass
+            add_parameter_value(target_db,target_class,target_parameter,alternative_name,target_byname,value)
 
-    # variable cost from node__to_unit must be turned to unit__to_node    
-    try:
-        target_db.commit_session("Added costs")
-    except:
-        print("commit adding costs error")
+    commit_stage(target_db,"Added mapped parameters","commit adding mapped parameters error")
 
 def add_emissions(source_db,target_db):
 
@@ -615,13 +704,6 @@ def add_emissions(source_db,target_db):
             add_parameter_value(target_db,"asset","type","Base",("atmosphere",),"storage")
 
             if param_map["type"] == "map":
-                # getting periods info
-                starttime = {} 
-                year_repr = {} 
-                for period in json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "period")[0]["value"])["data"]:
-                    starttime[period] = json.loads(source_db.get_parameter_value_item(entity_class_name = "period", entity_byname = (period,), alternative_name = "Base", parameter_definition_name = "start_time")["value"])["data"]
-                    year_repr[period] = source_db.get_parameter_value_item(entity_class_name = "period", entity_byname = (period,), alternative_name = "Base", parameter_definition_name = "years_represented")["parsed_value"]
-
                 map_table = convert_map_to_table(param_map["parsed_value"])
                 index_names = nested_index_names(param_map["parsed_value"])
                 data = pd.DataFrame(map_table, columns=index_names + ["value"]).set_index(index_names[0])
@@ -648,21 +730,43 @@ def add_emissions(source_db,target_db):
         co2_params = source_db.get_parameter_value_items(entity_class_name="node",parameter_definition_name="co2_content",alternative_name="Base")
         co2_value  = {co2_param["entity_name"]:co2_param["parsed_value"] for co2_param in co2_params if co2_param["entity_name"] != "CO2"}
         
-        for unit_entity in source_db.get_entity_items(entity_class_name="unit"):
-            unit__from_nodes = [from_node for from_node in co2_value if source_db.get_entity_item(entity_class_name = "node__to_unit",entity_byname = (from_node,unit_entity["name"]))]       
-            unit_name = unit_entity["name"]
-            if len(unit__from_nodes) > 1:
-                exit("Entity using more than one fossil fuel")
-                #for from_node in unit__from_nodes:
-
-            if len(unit__from_nodes) == 1:
-                add_entity(target_db,"asset__asset",(unit_name,"atmosphere"))
-                for year in years:
-                    add_entity(target_db,"asset__asset__commission",(unit_name,"atmosphere",year))
-                    add_parameter_value(target_db,"asset__asset__commission","capacity_coefficient","Base",(unit_name,"atmosphere",year),0.0)
-                    add_entity(target_db,"asset__asset__year",(unit_name,"atmosphere",year))
-                    add_entity(target_db,"asset_flow__asset_flow",(unit_name,"atmosphere",year,unit__from_nodes[0],unit_name,year))
-                    add_parameter_value(target_db,"asset_flow__asset_flow","ratio","Base",(unit_name,"atmosphere",year,unit__from_nodes[0],unit_name,year),co2_value[unit__from_nodes[0]])
+        # unit inputs joined once with the CO2 content of their fossil nodes
+        unit_fuels = pd.DataFrame([entity_item["entity_byname"] for entity_item in source_db.get_entity_items(entity_class_name = "node__to_unit")], columns = ["fuel","unit"])
+        unit_fuels = unit_fuels[unit_fuels["fuel"].isin(list(co2_value))].reset_index(drop = True)
+        unit_fuels["co2_content"] = unit_fuels["fuel"].map(co2_value).astype(float)
+
+        # units burning several fuels get a fixed fuel mix, shares follow the input capacities (equal shares when any is missing)
+        # each fuel ratio is the mix's weighted CO2 content over the fuel share, so all relationships of a unit agree
+        input_capacities = {tuple(capacity_param["entity_byname"]):capacity_param["parsed_value"] for capacity_param in source_db.get_parameter_value_items(entity_class_name = "node__to_unit", parameter_definition_name = "capacity", alternative_name = "Base") if capacity_param["type"] == "float"}
+        unit_fuels["capacity"] = [input_capacities.get((fuel,unit),np.nan) for fuel, unit in zip(unit_fuels["fuel"],unit_fuels["unit"])]
+        by_unit = unit_fuels.groupby("unit")
+        missing = unit_fuels["capacity"].isna().groupby(unit_fuels["unit"]).transform("any")
+        total = by_unit["capacity"].transform("sum")
+        unit_fuels["share"] = np.where(missing | (total <= 0.0), 1.0 / by_unit["fuel"].transform("size"), unit_fuels["capacity"] / total)
+        unit_fuels["ratio"] = (unit_fuels["co2_content"] * unit_fuels["share"]).groupby(unit_fuels["unit"]).transform("sum") / unit_fuels["share"]
+
+        # pairwise flow relationships cannot sum emissions over fuels, the mix above pins fuel flows to the shares
+        fuel_counts = by_unit["fuel"].transform("size")
+        for unit_name, mix in unit_fuels[fuel_counts > 1].groupby("unit"):
+            shares = ", ".join(f"{fuel} {share:.0%}" for fuel, share in zip(mix["fuel"],mix["share"]))
+            if not settings.get("fixed_fuel_mix", False):
+                raise RuntimeError(f"Unit {unit_name} uses more than one fossil fuel, set fixed_fuel_mix in settings.yaml to convert it with a fixed fuel mix ({shares})")
+            print(f"warning: unit {unit_name} burns its fossil fuels in a fixed mix: {shares}")
+
+        emitting_units = unit_fuels["unit"].unique().tolist()
+        for unit_name in emitting_units:
+            add_entity(target_db,"asset__asset",(unit_name,"atmosphere"))
+        for unit_name, year in pd.MultiIndex.from_product([emitting_units,years]):
+            add_entity(target_db,"asset__asset__commission",(unit_name,"atmosphere",year))
+            add_parameter_value(target_db,"asset__asset__commission","capacity_coefficient","Base",(unit_name,"atmosphere",year),0.0)
+            add_entity(target_db,"asset__asset__year",(unit_name,"atmosphere",year))
+        for unit_name, fuel, ratio, year in unit_fuels[["unit","fuel","ratio"]].merge(pd.DataFrame({"year":years}), how = "cross").itertuples(index = False):
+            try:
+                add_entity(target_db,"asset__asset__year",(fuel,unit_name,year))
+            except:
+                pass
+            add_entity(target_db,"asset_flow__asset_flow",(unit_name,"atmosphere",year,fuel,unit_name,year))
+            add_parameter_value(target_db,"asset_flow__asset_flow","ratio","Base",(unit_name,"atmosphere",year,fuel,unit_name,year),float(ratio))
 
         for entity_items in [element for element in source_db.get_entity_items(entity_class_name="unit__to_node") if "CO2" in element["entity_byname"][1]]:
             entity_byname = entity_items["entity_byname"]
@@ -675,11 +779,7 @@ def add_emissions(source_db,target_db):
                 add_entity(target_db,"asset_flow__asset_flow",("atmosphere",unit_name,year,unit_name,node_out,year))
                 add_parameter_value(target_db,"asset_flow__asset_flow","ratio","Base",("atmosphere",unit_name,year,unit_name,node_out,year),1.0)
 
-    # missing when entity uses more than one fossil fuel
-    try:
-        target_db.commit_session("Added emissions")
-    except:
-        print("commit adding emissions error")
+    commit_stage(target_db,"Added emissions","commit adding emissions error")
 
 def add_profiles(source_db,target_db):
 
@@ -689,6 +789,8 @@ def add_profiles(source_db,target_db):
     duration      = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "duration")[0]["value"])["data"]
     starttime_sp  = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "start_time")[0]["value"])["data"]
     resolution    = json.loads(source_db.get_parameter_value_items(entity_class_name = "solve_pattern", parameter_definition_name = "time_resolution")[0]["value"])["data"]
+    steps_source, factor = resampling_factor(duration, resolution)
+    steps = steps_source // factor
 
     parameters = {"storage_state_upper_limit":"max_storage_level","storage_state_lower_limit":"min_storage_level","availability":"availability","profile_fix":"availability","profile_limit_upper":"availability"}
     for parameter in parameters:
@@ -727,8 +829,8 @@ def add_profiles(source_db,target_db):
                             add_alternative(target_db,alternative_name)
                         except:
                             pass
-                        steps = int(pd.to_timedelta(duration) / pd.to_timedelta(resolution))
-                        df_data = data.iloc[data.index.tolist().index(element):data.index.tolist().index(element)+int(steps),data.columns.tolist().index("value")].tolist()
+                        start = data.index.get_loc(element)
+                        df_data = resample(data["value"].to_numpy()[start:start+steps_source],factor,resample_methods[parameters[parameter]]).tolist()
                         profile_map = {"type":"map","index_type":"float","index_name":"period","data":{1.0:{"type":"map","index_type":"str","index_name":"timestep","data":dict(zip(range(1,steps+1),df_data))}}}
                         for year in years:
                             add_parameter_value(target_db,"profile__year","profile_period_timestep",alternative_name,(profile_name,year),profile_map)
@@ -773,8 +875,8 @@ def add_profiles(source_db,target_db):
                         add_alternative(target_db,alternative_name)
                     except:
                         pass
-                    steps = int(pd.to_timedelta(duration) / pd.to_timedelta(resolution))
-                    df_data = ((-1 if parameter_type == "demand" else 1.0)*data.iloc[data.index.tolist().index(element):data.index.tolist().index(element)+int(steps),data.columns.tolist().index("value")]).tolist()
+                    start = data.index.get_loc(element)
+                    df_data = ((-1 if parameter_type == "demand" else 1.0)*resample(data["value"].to_numpy()[start:start+steps_source],factor,resample_methods[parameter_type])).tolist()
                     profile_map = {"type":"map","index_type":"float","index_name":"period","data":{1.0:{"type":"map","index_type":"str","index_name":"timestep","data":dict(zip(range(1,steps+1),df_data))}}}
                     for year in years:
                         add_parameter_value(target_db,"profile__year","profile_period_timestep",alternative_name,(profile_name,year),profile_map)
@@ -809,11 +911,16 @@ def add_profiles(source_db,target_db):
                 except:
                     pass
                 add_parameter_value(target_db,"asset__year",parameter_name,"Base",(target_name,year),1.0)
-    try:
-        target_db.commit_session("Added profiles")
-    except:
-        print("commit adding profiles error")
+    commit_stage(target_db,"Added profiles","commit adding profiles error")
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        url_db_in = sys.argv[1]
+    else:
+        exit("Please provide input database url and output database url as arguments. They should be of the form ""sqlite:///path/db_file.sqlite""")
+    if len(sys.argv) > 2:
+        url_db_out = sys.argv[2]
+    else:
+        exit("Please provide input database url and output database url as arguments. They should be of the form ""sqlite:///path/db_file.sqlite""")
+    main(url_db_in, url_db_out)
 
@@ -0,0 +1,171 @@
+import spinedb_api as api
+from spinedb_api import DatabaseMapping
+from spinedb_api.parameter_value import IndexedValue
+from sqlalchemy.engine import make_url
+import sqlite3
+import hashlib
+import math
+import json
+import sys
+import numpy as np
+
+# floats are hashed after rounding to this many significant digits, which is not a tolerance:
+# close values on both sides of a rounding boundary hash differently, diff re-checks them with math.isclose
+significant_digits = 9
+relative_tolerance = 1e-9
+fingerprint_metadata_name = "tulipa_fingerprint"
+
+def canonical_value(value):
+    if isinstance(value, IndexedValue):
+        return [value.index_name,[[str(index),canonical_value(element)] for index, element in zip(value.indexes,value.values)]]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+def rounded_value(value):
+    if isinstance(value, list):
+        return [rounded_value(element) for element in value]
+    if isinstance(value, float):
+        return float(f"{value:.{significant_digits}g}")
+    return value
+
+def row_digest(group : tuple, key : tuple, value = None) -> int:
+    row = json.dumps([group,key,rounded_value(value)], separators = (",",":"))
+    return int.from_bytes(hashlib.sha256(row.encode()).digest()[:16], "big")
+
+def rows_from_sqlite(path : str):
+    # streams (group, key, canonical value) rows straight from the tables of a Spine sqlite file
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri = True)
+    try:
+        class_names = dict(connection.execute("SELECT id, name FROM entity_class"))
+        alternative_names = dict(connection.execute("SELECT id, name FROM alternative"))
+        scenario_names = dict(connection.execute("SELECT id, name FROM scenario"))
+        parameter_names = dict(connection.execute("SELECT id, name FROM parameter_definition"))
+        # values of value-list parameters are stored as references to list_value rows
+        list_values = {list_value_id:(value,value_type) for list_value_id, value, value_type in connection.execute("SELECT id, value, type FROM list_value")}
+        entities = {entity_id:(class_id,name) for entity_id, class_id, name in connection.execute("SELECT id, class_id, name FROM entity")}
+        elements = {}
+        for entity_id, element_id in connection.execute("SELECT entity_id, element_id FROM entity_element ORDER BY entity_id, position"):
+            elements.setdefault(entity_id,[]).append(element_id)
+
+        bynames = {}
+        def byname(entity_id):
+            if entity_id not in bynames:
+                if entity_id in elements:
+                    bynames[entity_id] = tuple(name for element_id in elements[entity_id] for name in byname(element_id))
+                else:
+                    bynames[entity_id] = (entities[entity_id][1],)
+            return bynames[entity_id]
+
+        for name in alternative_names.values():
+            yield ("alternative",), (name,), None
+        for name in scenario_names.values():
+            yield ("scenario",), (name,), None
+        for scenario_id, alternative_id, rank in connection.execute("SELECT scenario_id, alternative_id, rank FROM scenario_alternative"):
+            yield ("scenario_alternative",), (scenario_names[scenario_id],alternative_names[alternative_id]), rank
+        for entity_id, (class_id, _) in entities.items():
+            yield ("entity",class_names[class_id]), byname(entity_id), None
+        for class_id, entity_id, definition_id, alternative_id, value, value_type in connection.execute("SELECT entity_class_id, entity_id, parameter_definition_id, alternative_id, value, type FROM parameter_value"):
+            group = ("parameter_value",class_names[class_id],parameter_names[definition_id])
+            if value_type == "list_value_ref":
+                value, value_type = list_values[int(value)]
+            yield group, byname(entity_id) + (alternative_names[alternative_id],), canonical_value(api.from_database(value,value_type))
+    finally:
+        connection.close()
+
+def rows_from_db_map(db_map : DatabaseMapping):
+    # same rows as rows_from_sqlite, taken from the (possibly uncommitted) items of an open mapping
+    for alternative in db_map.get_alternative_items():
+        yield ("alternative",), (alternative["name"],), None
+    for scenario in db_map.get_scenario_items():
+        yield ("scenario",), (scenario["name"],), None
+    for scenario_alternative in db_map.get_scenario_alternative_items():
+        yield ("scenario_alternative",), (scenario_alternative["scenario_name"],scenario_alternative["alternative_name"]), scenario_alternative["rank"]
+    for entity in db_map.get_entity_items():
+        yield ("entity",entity["entity_class_name"]), tuple(entity["entity_byname"]), None
+    for parameter_value in db_map.get_parameter_value_items():
+        group = ("parameter_value",parameter_value["entity_class_name"],parameter_value["parameter_definition_name"])
+        yield group, tuple(parameter_value["entity_byname"]) + (parameter_value["alternative_name"],), canonical_value(api.from_database(parameter_value["value"],parameter_value["type"]))
+
+def fingerprint(rows) -> dict:
+    # order-independent: row digests are summed per group
+    groups = {}
+    for group, key, value in rows:
+        count, total = groups.get(group,(0,0))
+        groups[group] = (count + 1, (total + row_digest(group,key,value)) % 2**128)
+    return groups
+
+def fingerprint_digest(groups : dict) -> str:
+    return hashlib.sha256(json.dumps(sorted([list(group),count,total] for group, (count, total) in groups.items())).encode()).hexdigest()
+
+def key_values(rows, groups : set) -> dict:
+    values = {group:{} for group in groups}
+    for group, key, value in rows:
+        if group in values:
+            values[group][key] = value
+    return values
+
+def values_close(value_a, value_b) -> bool:
+    if isinstance(value_a, list) and isinstance(value_b, list):
+        return len(value_a) == len(value_b) and all(values_close(a,b) for a, b in zip(value_a,value_b))
+    if isinstance(value_a, float) and isinstance(value_b, float):
+        return math.isclose(value_a,value_b,rel_tol = relative_tolerance)
+    return value_a == value_b
+
+def stored_fingerprint(path : str):
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri = True)
+    try:
+        stored = connection.execute("SELECT value FROM metadata WHERE name = ?", (fingerprint_metadata_name,)).fetchone()
+    except sqlite3.OperationalError:
+        stored = None
+    finally:
+        connection.close()
+    return stored[0] if stored else None
+
+def diff(path_a : str, path_b : str) -> dict:
+    groups_a = fingerprint(rows_from_sqlite(path_a))
+    groups_b = fingerprint(rows_from_sqlite(path_b))
+    differing = {group for group in set(groups_a) | set(groups_b) if groups_a.get(group) != groups_b.get(group)}
+    if not differing:
+        return {}
+    # second pass only over the groups whose hashes differ
+    values_a = key_values(rows_from_sqlite(path_a),differing)
+    values_b = key_values(rows_from_sqlite(path_b),differing)
+    differences = {}
+    for group in sorted(differing):
+        keys_a, keys_b = values_a[group], values_b[group]
+        difference = {
+            "only_in_a": sorted(set(keys_a) - set(keys_b)),
+            "only_in_b": sorted(set(keys_b) - set(keys_a)),
+            "changed": sorted(key for key in set(keys_a) & set(keys_b) if not values_close(keys_a[key],keys_b[key]))
+        }
+        if any(difference.values()):
+            differences[group] = difference
+    return differences
+
+def main():
+    if len(sys.argv) < 2:
+        exit("Please provide one database url to fingerprint or two to compare. They should be of the form ""sqlite:///path/db_file.sqlite""")
+    path_a = make_url(sys.argv[1]).database
+    if len(sys.argv) == 2:
+        groups = fingerprint(rows_from_sqlite(path_a))
+        for group in sorted(groups):
+            print("/".join(group), groups[group][0], format(groups[group][1],"032x"))
+        print("fingerprint", fingerprint_digest(groups), f"(floats rounded to {significant_digits} significant digits)")
+        return
+    differences = diff(path_a,make_url(sys.argv[2]).database)
+    if not differences:
+        print(f"databases are equal (floats within a relative tolerance of {relative_tolerance})")
+        return
+    for group, difference in differences.items():
+        for kind in ["only_in_a","only_in_b","changed"]:
+            for key in difference[kind]:
+                print("/".join(group), kind, key)
+    sys.exit(1)
+
+if __name__ == "__main__":
+    main()
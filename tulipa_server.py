@@ -0,0 +1,119 @@
+from spinedb_api import DatabaseMapping
+from sqlalchemy import func
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import ines_to_tulipa
+import threading
+import json
+import time
+import sys
+
+# item types re-fetched when the given source item type has new commits,
+# changes in any other item type (classes, definitions, value lists...) refresh the whole source
+refresh_dependents = {
+    "alternative": ["alternative","scenario_alternative","parameter_value"],
+    "scenario": ["scenario","scenario_alternative"],
+    "scenario_alternative": ["scenario_alternative"],
+    "entity": ["entity","entity_alternative","entity_group","parameter_value"],
+    "entity_alternative": ["entity_alternative"],
+    "entity_group": ["entity_group"],
+    "parameter_value": ["parameter_value"],
+}
+structure_types = ["entity_class","parameter_definition","parameter_value_list","list_value"]
+
+class ConversionService:
+    # keeps the source mapping, and so its fetched and parsed items, alive between conversions
+
+    def __init__(self, url_db_in : str):
+        self.source_db = DatabaseMapping(url_db_in)
+        self.lock = threading.Lock()
+        self.signatures = {}
+
+    def source_signatures(self) -> dict:
+        signatures = {}
+        for item_type in list(refresh_dependents) + structure_types:
+            subquery = getattr(self.source_db, item_type + "_sq")
+            columns = [func.count()] + ([func.max(subquery.c.commit_id)] if "commit_id" in subquery.c else [])
+            signatures[item_type] = tuple(self.source_db.query(*columns).select_from(subquery).one())
+        return signatures
+
+    def refresh_source(self) -> None:
+        signatures = self.source_signatures()
+        changed = [item_type for item_type in signatures if self.signatures and signatures[item_type] != self.signatures.get(item_type)]
+        if any(item_type in structure_types for item_type in changed):
+            print("source structure changed, refreshing all items")
+            self.source_db.refresh_session()
+        elif changed:
+            item_types = sorted({dependent for item_type in changed for dependent in refresh_dependents[item_type]})
+            print("refreshing", ", ".join(item_types))
+            self.source_db.reset(*item_types)
+        self.signatures = signatures
+
+    def convert(self, url_db_out : str, options : dict) -> float:
+        with self.lock:
+            start = time.perf_counter()
+            settings = dict(ines_to_tulipa.settings)
+            resample_methods = dict(ines_to_tulipa.resample_methods)
+            try:
+                ines_to_tulipa.settings.update(options)
+                ines_to_tulipa.update_resample_methods(options.get("resample_methods") or {})
+                with self.source_db:
+                    self.refresh_source()
+                    ines_to_tulipa.write_target(self.source_db, url_db_out)
+            finally:
+                ines_to_tulipa.settings.clear()
+                ines_to_tulipa.settings.update(settings)
+                ines_to_tulipa.resample_methods.clear()
+                ines_to_tulipa.resample_methods.update(resample_methods)
+            return time.perf_counter() - start
+
+def request_handler(service : ConversionService):
+
+    class ConvertHandler(BaseHTTPRequestHandler):
+        # POST /convert with {"target": url, "settings": {...}} converts the source into the target url
+
+        def reply(self, code : int, body : dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type","application/json")
+            self.send_header("Content-Length",str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path != "/convert":
+                self.reply(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length",0))) or "{}")
+                if "target" not in request:
+                    self.reply(400, {"error": "missing target url"})
+                    return
+                seconds = service.convert(request["target"], request.get("settings") or {})
+            except (Exception, SystemExit) as error:
+                # the converter reports unsupported data with RuntimeError, an exit() left anywhere must not kill the reply
+                self.reply(500, {"error": repr(error)})
+                return
+            self.reply(200, {"target": request["target"], "seconds": seconds})
+
+    return ConvertHandler
+
+def main():
+    if len(sys.argv) > 1:
+        url_db_in = sys.argv[1]
+    else:
+        exit("Please provide the input database url as argument. It should be of the form ""sqlite:///path/db_file.sqlite""")
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+
+    service = ConversionService(url_db_in)
+    server = ThreadingHTTPServer(("127.0.0.1", port), request_handler(service))
+    print(f"converting {url_db_in} on http://127.0.0.1:{port}/convert")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.source_db.close()
+
+if __name__ == "__main__":
+    main()